@@ -1 +1 @@
-from .vendista import Type, Picture, ConnectState, Currency, Vendista
\ No newline at end of file
+from .vendista import Type, Picture, ConnectState, Currency, TYPE_DESC, PICTURE_DESC, CONNECT_STATE_DESC, CURRENCY_DESC, Vendista
\ No newline at end of file
@@ -0,0 +1,87 @@
+/*
+ * CRC-16 (poly 0x8005, init 0xFFFF, xorout 0xFFFF, refin/refout false)
+ * Slicing-by-8 implementation for the Vendista serial protocol.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#define CRC16_POLY 0x8005
+
+static uint16_t crc16_tables[8][256];
+
+static void crc16_init_tables(void)
+{
+    for (int byte = 0; byte < 256; byte++) {
+        uint16_t crc = (uint16_t)(byte << 8);
+        for (int bit = 0; bit < 8; bit++)
+            crc = (crc & 0x8000) ? (uint16_t)((crc << 1) ^ CRC16_POLY) : (uint16_t)(crc << 1);
+        crc16_tables[0][byte] = crc;
+    }
+    /* T[k][v] is the CRC of byte v followed by k zero bytes */
+    for (int k = 1; k < 8; k++) {
+        for (int byte = 0; byte < 256; byte++) {
+            uint16_t crc = crc16_tables[k - 1][byte];
+            crc16_tables[k][byte] = (uint16_t)(crc << 8) ^ crc16_tables[0][crc >> 8];
+        }
+    }
+}
+
+static uint16_t crc16_8005(const uint8_t *buf, size_t n)
+{
+    uint16_t crc = 0xFFFF;
+    while (n >= 8) {
+        crc = crc16_tables[7][buf[0] ^ (crc >> 8)]
+            ^ crc16_tables[6][buf[1] ^ (crc & 0xFF)]
+            ^ crc16_tables[5][buf[2]]
+            ^ crc16_tables[4][buf[3]]
+            ^ crc16_tables[3][buf[4]]
+            ^ crc16_tables[2][buf[5]]
+            ^ crc16_tables[1][buf[6]]
+            ^ crc16_tables[0][buf[7]];
+        buf += 8;
+        n -= 8;
+    }
+    while (n--)
+        crc = (uint16_t)(crc << 8) ^ crc16_tables[0][(crc >> 8) ^ *buf++];
+    return crc ^ 0xFFFF;
+}
+
+static PyObject *py_crc16_8005(PyObject *self, PyObject *args)
+{
+    Py_buffer view;
+    uint16_t crc;
+
+    (void)self;
+    if (!PyArg_ParseTuple(args, "y*:crc16_8005", &view))
+        return NULL;
+    crc = crc16_8005((const uint8_t *)view.buf, (size_t)view.len);
+    PyBuffer_Release(&view);
+    return PyLong_FromUnsignedLong(crc);
+}
+
+static PyMethodDef crc_methods[] = {
+    {"crc16_8005", py_crc16_8005, METH_VARARGS, "crc16_8005(data) -> int\n\nCRC-16/0x8005 of a bytes-like object."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef crc_module = {
+    PyModuleDef_HEAD_INIT,
+    "_vendista_crc",
+    "Slicing-by-8 CRC-16 for the Vendista protocol",
+    -1,
+    NULL, NULL, NULL, NULL, NULL
+};
+
+PyMODINIT_FUNC PyInit__vendista_crc(void)
+{
+    PyObject *m = PyModule_Create(&crc_module);
+    if (m == NULL)
+        return NULL;
+    if (PyModule_AddFunctions(m, crc_methods) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    crc16_init_tables();
+    return m;
+}
@@ -1,135 +1,254 @@
 #!/usr/bin/python
 import threading
 import logging
+import selectors
+import socket
 from time import time, sleep
 from serial import Serial, SerialException, PARITY_NONE, STOPBITS_ONE, EIGHTBITS
 import struct
-from queue import Queue
-import binascii
+from queue import Queue, Empty
+from concurrent.futures import Future, TimeoutError
 from dataclasses import dataclass
-from enum import Enum
-import libscrc
+from enum import IntEnum
+import numpy as np
+from numba import njit
 
 logger = logging.getLogger("vendista")
 
-class IntEnum(int, Enum):
-    description: str
+def crc16_table(poly: int = 0x8005):
+    table = np.empty(256, dtype=np.uint16)
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+        table[byte] = crc
+    return np.ascontiguousarray(table, dtype=np.uint16)
 
-    def __int__(self):
-        return self.value
+# Global array is frozen into the compiled function as a constant
+CRC16_TABLE = crc16_table()
 
-    def __bytes__(self):
-        return self.value.to_bytes(1)
+@njit(cache=True, boundscheck=False)
+def crc16_8005(buf: np.ndarray) -> np.uint16:
+    # CRC-16, poly 0x8005, init 0xFFFF, xorout 0xFFFF, refin/refout False
+    crc = np.uint16(0xFFFF)
+    for i in range(buf.size):
+        crc = np.uint16((crc << 8) ^ CRC16_TABLE[((crc >> 8) ^ buf[i]) & 0xFF])
+    return crc ^ np.uint16(0xFFFF)
 
-    def __str__(self):
-        return self.description
+def calc_crc16(body) -> int:
+    return int(crc16_8005(np.frombuffer(body, dtype=np.uint8)))
+
+try:
+    # Slicing-by-8 C implementation (_vendista_crc.c), if built
+    from ._vendista_crc import crc16_8005 as calc_crc16
+except ImportError:
+    pass
 
-    def __eq__(self, other):
-        return self.value == other
-    
-    def __ne__(self, other):
-        return self.value != other
-
-    def __new__(cls, value: int, description: str = ""):
-        obj = int.__new__(cls, value)
-        obj._value_ = value
-        obj.description = description
-        return obj
-    
 class Type(IntEnum):
-    READ_CARD = 0x01, "Read card"
-    PACKET_FROM_SERVER = 0x02, "Packet from server"
-    SHOW_PICTURE = 0x03, "Show picture"
-    SHOW_QR = 0x04, "Show QR"
-    REBOOT = 0x05, "Reboot"
-    PING_SERVER = 0x06, "Ping server"
-    CANCEL_LAST_TRANSACTION = 0x07, "Cancel last transaction" # Отменить последнюю транзакцию (оплату с карты). В ответ терминал вернет пакет PacketToServer
-    CANCEL_READ_CARD = 0x08, "Cancel read card"     # Отменить команду ReadCard
-    FILL_SCREEN = 0x09, "Fill screen"               # Очистить экран (заполнить одним цветом)
-    WRITE_LINE = 0x0A, "Write line"                 # Вывести на экран строку текста
-    SERVER_CONNECT_STATE = 0x0B, "Server connect state" # Уведомить Slave о состоянии соединения с сервером (актуально только для режима Slave + MDB)
-    SET_CUSTOM_VALUE = 0x0C, "Set custom value"     # Установить значение внутренней переменной в Slave
-    VEND_REPORT = 0x0E, "Vend report"               # Зарегистрировать продажу (нал/безнал) с формированием фискального чека в онлайн кассе
-    PACKET_TO_EXT_SERVER = 0x0F, "Custom packet to external server" # Отправить на сервер произвольный пакет (для пересылки на Внешний сервер Master).  В ответ Slave отправит пакет на свой сервер препроцессинга (если у него есть своя симка), и вернет на Master этот же пакет через PacketToServer
-    CONNECT_STATE_REQUEST = 0x10, "Server connect state request" # Запросить состояние соединения Slave со своим сервером процессинга. Актуально при использовании симки Slave
-    TOUCH = 0x11, "Touch"                           # Уведомление о нажатии на LCD
-    PACKET_TO_SERVER = 0x12, "Packet to server"     # Инструкция для Master - отправить пакет на сервер
-    CARD_READ_RESULT = 0x13, "Card read result"     # Результат поиска и чтения карты
-    CARD_AUTH_RESULT = 0x14, "Card authorization result" # Результат авторизации карты: оплата отклонена или принята
-    ACK = 0x15, "Ack"                               # Подтверждение приема пакета от Master
-    REBOOT_REPORT = 0x16, "Reboot report"           # Уведомление о перезагрузке
-    CONNECT_STATE_REPORT = 0x18, "Server connect state report" # Уведомление о состоянии соединения Slave со своим сервером процессинга
-    PACKET_TO_MASTER = 0x1B, "Custom packet to master" # Передача произвольного пакета данных пользователя на Master
-    WRITE_TEXT_RECT = 0x30, "Write text and rectangle" # Предназначена для пакетной отрисовки примитивов(прямоугольников) и вывода текста
-    VEND_REQUEST = 0x31, "Vend request"             # Запрос на продажу для получения QR на оплату (QR СБП)
+    READ_CARD = 0x01
+    PACKET_FROM_SERVER = 0x02
+    SHOW_PICTURE = 0x03
+    SHOW_QR = 0x04
+    REBOOT = 0x05
+    PING_SERVER = 0x06
+    CANCEL_LAST_TRANSACTION = 0x07  # Отменить последнюю транзакцию (оплату с карты). В ответ терминал вернет пакет PacketToServer
+    CANCEL_READ_CARD = 0x08         # Отменить команду ReadCard
+    FILL_SCREEN = 0x09              # Очистить экран (заполнить одним цветом)
+    WRITE_LINE = 0x0A               # Вывести на экран строку текста
+    SERVER_CONNECT_STATE = 0x0B     # Уведомить Slave о состоянии соединения с сервером (актуально только для режима Slave + MDB)
+    SET_CUSTOM_VALUE = 0x0C         # Установить значение внутренней переменной в Slave
+    VEND_REPORT = 0x0E              # Зарегистрировать продажу (нал/безнал) с формированием фискального чека в онлайн кассе
+    PACKET_TO_EXT_SERVER = 0x0F     # Отправить на сервер произвольный пакет (для пересылки на Внешний сервер Master).  В ответ Slave отправит пакет на свой сервер препроцессинга (если у него есть своя симка), и вернет на Master этот же пакет через PacketToServer
+    CONNECT_STATE_REQUEST = 0x10    # Запросить состояние соединения Slave со своим сервером процессинга. Актуально при использовании симки Slave
+    TOUCH = 0x11                    # Уведомление о нажатии на LCD
+    PACKET_TO_SERVER = 0x12         # Инструкция для Master - отправить пакет на сервер
+    CARD_READ_RESULT = 0x13         # Результат поиска и чтения карты
+    CARD_AUTH_RESULT = 0x14         # Результат авторизации карты: оплата отклонена или принята
+    ACK = 0x15                      # Подтверждение приема пакета от Master
+    REBOOT_REPORT = 0x16            # Уведомление о перезагрузке
+    CONNECT_STATE_REPORT = 0x18     # Уведомление о состоянии соединения Slave со своим сервером процессинга
+    PACKET_TO_MASTER = 0x1B         # Передача произвольного пакета данных пользователя на Master
+    WRITE_TEXT_RECT = 0x30          # Предназначена для пакетной отрисовки примитивов(прямоугольников) и вывода текста
+    VEND_REQUEST = 0x31             # Запрос на продажу для получения QR на оплату (QR СБП)
+
+TYPE_DESC: dict[Type, str] = {
+    Type.READ_CARD: "Read card",
+    Type.PACKET_FROM_SERVER: "Packet from server",
+    Type.SHOW_PICTURE: "Show picture",
+    Type.SHOW_QR: "Show QR",
+    Type.REBOOT: "Reboot",
+    Type.PING_SERVER: "Ping server",
+    Type.CANCEL_LAST_TRANSACTION: "Cancel last transaction",
+    Type.CANCEL_READ_CARD: "Cancel read card",
+    Type.FILL_SCREEN: "Fill screen",
+    Type.WRITE_LINE: "Write line",
+    Type.SERVER_CONNECT_STATE: "Server connect state",
+    Type.SET_CUSTOM_VALUE: "Set custom value",
+    Type.VEND_REPORT: "Vend report",
+    Type.PACKET_TO_EXT_SERVER: "Custom packet to external server",
+    Type.CONNECT_STATE_REQUEST: "Server connect state request",
+    Type.TOUCH: "Touch",
+    Type.PACKET_TO_SERVER: "Packet to server",
+    Type.CARD_READ_RESULT: "Card read result",
+    Type.CARD_AUTH_RESULT: "Card authorization result",
+    Type.ACK: "Ack",
+    Type.REBOOT_REPORT: "Reboot report",
+    Type.CONNECT_STATE_REPORT: "Server connect state report",
+    Type.PACKET_TO_MASTER: "Custom packet to master",
+    Type.WRITE_TEXT_RECT: "Write text and rectangle",
+    Type.VEND_REQUEST: "Vend request",
+}
 
 class Picture(IntEnum):
-    PRESS_KEY_FOR_PAYMENT = 1, "Press key for payment"   # Нажмите кнопку для оплаты картой
-    SELECT_GOODS = 2, "Select goods"                # Выберите товар на автомате
-    AUTHORIZATION = 4, "Authorization"              # Авторизация 
-    SUCCESS = 5, "Success"                          # Успешно 
-    REJECTED = 6, "Rejected"                        # Отклонено  
-    UNAVAILABLE = 8, "Unavailable"                  # Недоступно 
-    WAIT = 9, "Wait"                                # Ожидайте 
-    ERROR = 12, "Error"                             # Ошибка 
-    CUSTOM = 13, "Custom"                           # Кастомная картинка 
-    CANCEL = 14, "Cancel"                           # Отмена последней транзакции успешно выполнена (деньги вернулись на карту) 
+    PRESS_KEY_FOR_PAYMENT = 1     # Нажмите кнопку для оплаты картой
+    SELECT_GOODS = 2              # Выберите товар на автомате
+    AUTHORIZATION = 4             # Авторизация
+    SUCCESS = 5                   # Успешно
+    REJECTED = 6                  # Отклонено
+    UNAVAILABLE = 8               # Недоступно
+    WAIT = 9                      # Ожидайте
+    ERROR = 12                    # Ошибка
+    CUSTOM = 13                   # Кастомная картинка
+    CANCEL = 14                   # Отмена последней транзакции успешно выполнена (деньги вернулись на карту)
+
+PICTURE_DESC: dict[Picture, str] = {
+    Picture.PRESS_KEY_FOR_PAYMENT: "Press key for payment",
+    Picture.SELECT_GOODS: "Select goods",
+    Picture.AUTHORIZATION: "Authorization",
+    Picture.SUCCESS: "Success",
+    Picture.REJECTED: "Rejected",
+    Picture.UNAVAILABLE: "Unavailable",
+    Picture.WAIT: "Wait",
+    Picture.ERROR: "Error",
+    Picture.CUSTOM: "Custom",
+    Picture.CANCEL: "Cancel",
+}
 
 class ConnectState(IntEnum):
-    NONE = 0, "None"
-    DISCONNECTED = 1, "Disconnected"
-    SIM800_FOUND = 2, "SIM800 found"
-    SIM800_NOT_FOUND = 3, "SIM800 not found"
-    SIM_FOUND = 4, "SIM found"
-    REG_PASSED = 5, "GSM reg passed"
-    PHONE_NUM_ACQ = 6, "Phone num acquired"
-    GPRS_ACTIVE = 7, "GPRS active"
-    IP_ACQ = 8, "IP acquired"
-    SERVER_CONNECTED = 9, "Server connected"
+    NONE = 0
+    DISCONNECTED = 1
+    SIM800_FOUND = 2
+    SIM800_NOT_FOUND = 3
+    SIM_FOUND = 4
+    REG_PASSED = 5
+    PHONE_NUM_ACQ = 6
+    GPRS_ACTIVE = 7
+    IP_ACQ = 8
+    SERVER_CONNECTED = 9
+
+CONNECT_STATE_DESC: dict[ConnectState, str] = {
+    ConnectState.NONE: "None",
+    ConnectState.DISCONNECTED: "Disconnected",
+    ConnectState.SIM800_FOUND: "SIM800 found",
+    ConnectState.SIM800_NOT_FOUND: "SIM800 not found",
+    ConnectState.SIM_FOUND: "SIM found",
+    ConnectState.REG_PASSED: "GSM reg passed",
+    ConnectState.PHONE_NUM_ACQ: "Phone num acquired",
+    ConnectState.GPRS_ACTIVE: "GPRS active",
+    ConnectState.IP_ACQ: "IP acquired",
+    ConnectState.SERVER_CONNECTED: "Server connected",
+}
 
 class Currency(IntEnum): # ISO 4217
-    RUB = 643, "RUB"
-    USD = 840, "USD"
-    EUR = 978, "EUR"
+    RUB = 643
+    USD = 840
+    EUR = 978
     
     def bcd(self):
-        bcd_value = 0
-        multiplier = 1
-        number = self.value
-        while number > 0:
-            digit = number % 10
-            bcd_value += digit * multiplier
-            multiplier *= 16
-            number //= 10
-        lower_byte = (bcd_value & 0x00FF) << 8
-        upper_byte = (bcd_value & 0xFF00) >> 8
-        return lower_byte | upper_byte
+        return CURRENCY_BCD[self]
+
+CURRENCY_DESC: dict[Currency, str] = {
+    Currency.RUB: "RUB",
+    Currency.USD: "USD",
+    Currency.EUR: "EUR",
+}
+
+def currency_bcd(number: int) -> int:
+    bcd_value = 0
+    multiplier = 1
+    while number > 0:
+        digit = number % 10
+        bcd_value += digit * multiplier
+        multiplier *= 16
+        number //= 10
+    lower_byte = (bcd_value & 0x00FF) << 8
+    upper_byte = (bcd_value & 0xFF00) >> 8
+    return lower_byte | upper_byte
+
+CURRENCY_BCD: dict[Currency, int] = { currency: currency_bcd(currency.value) for currency in Currency }
+
+header_format = struct.Struct('<HH')
+
+def encode_packet(packet_type: Type, data: bytes | None = None) -> bytes:
+    if data is not None:
+        body = packet_type.to_bytes(1) + data
+    else:
+        body = packet_type.to_bytes(1)
+    return header_format.pack(len(body), calc_crc16(body)) + body
+
+# Packets without payload and SHOW_PICTURE packets are fully serialized once
+PREBUILT_PACKETS: dict[Type, bytes] = { packet_type: encode_packet(packet_type) for packet_type in Type }
+PREBUILT_SHOW_PICTURE: dict[Picture, bytes] = { id: encode_packet(Type.SHOW_PICTURE, id.to_bytes(1)) for id in Picture }
+
+@dataclass(slots=True)
+class PendingPayment:
+    amount: float
+    active: bool
+    time: float
+    card_number: str = ""
 
 class Vendista(object):
 
-    def __init__(self, serial_port, event_queue: Queue, log_level=logging.INFO):
+    def __init__(self, serial_port, event_queue: Queue, log_level=logging.INFO, verify_crc: bool = True):
         self.serial_port = serial_port
         self.event_queue = event_queue
+        self.verify_crc = verify_crc # CRC of received packets, sent packets always carry it
         logger.setLevel(log_level)
 
         self.port: Serial | None = None
-        self.lock = threading.Lock()
-        self.pending_payment = None
+        self.selector: selectors.BaseSelector | None = None
+        # All serial I/O is done by vendista_loop, other threads queue their requests
+        self._tx_queue: Queue[tuple[Type, bytes | None, bytes | None, Future]] = Queue()
+        self._tx_buf = bytearray(512)
+        self._tx_view = memoryview(self._tx_buf)
+        # Received bytes are kept until they form a complete packet
+        self._rx_buf = bytearray(4096)
+        self._rx_view = memoryview(self._rx_buf)
+        self._rx_tail = 0
+        self._rx_time = 0.0
+        # ACKs still expected for packets sent without waiting for a response
+        self._pending_raw_acks = 0
+        # Warm up JIT for received (read-only) and sent (writable) buffers
+        calc_crc16(Type.ACK.to_bytes(1))
+        calc_crc16(self._tx_view[:1])
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.pending_payment: PendingPayment | None = None
+        self._last_shown_picture: Picture | None = None
         self.connect_state = ConnectState.NONE
         self.connection_error = False
         self.last_check_time = None
+        self.last_request_time = None
         self.error_counter = 10
-        self.header_format = struct.Struct('<HH')
+        self.header_format = header_format
         self.packet_read_card = struct.Struct('<LHLB')
         self.packet_show_qr = struct.Struct('<pp')
         self.packet_vend_request = struct.Struct('<HHB')
         self.packet_fill_screen = struct.Struct('<H')
         self.packet_write_line = struct.Struct('<HHBHHp')
         self.packet_card_read_result = struct.Struct('<B8s')
+        self._event_handlers = {
+            Type.TOUCH: self._on_touch,
+            Type.CARD_READ_RESULT: self._on_card_read,
+            Type.CARD_AUTH_RESULT: self._on_card_auth,
+            Type.CONNECT_STATE_REPORT: self._on_connect_state,
+        }
 
         self.stop_request = threading.Event()
-        vendista_loop_thread = threading.Thread(target=self.vendista_loop, daemon=True, name="vendista")
-        vendista_loop_thread.start()
+        self.vendista_loop_thread = threading.Thread(target=self.vendista_loop, daemon=True, name="vendista")
+        self.vendista_loop_thread.start()
 
     def open(self):
         if self.port and self.port.is_open:
@@ -143,38 +262,89 @@ class Vendista(object):
             timeout = 1.0
         )
         logger.info(f"Port {self.serial_port} opened")
-        self.show_picture(Picture.WAIT)
+        if self.selector is not None:
+            self.selector.close()
+        try:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.port, selectors.EVENT_READ)
+            self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+        except ValueError:
+            # Port has no file descriptor (not POSIX), poll in_waiting instead
+            self.selector.close()
+            self.selector = None
+        self._rx_tail = 0
+        self._pending_raw_acks = 0
+        # Don't wait for ACK, it is skipped by the next receive() or _transact()
+        self._send_raw(PREBUILT_SHOW_PICTURE[Picture.WAIT])
+        self._last_shown_picture = None
+
+    def _send_raw(self, packet: bytes):
+        self.last_request_time = time()
+        self.port.write(packet)
+        self._pending_raw_acks += 1
 
     def close(self):
         if not self.stop_request.is_set():
             self.stop_request.set()
             logger.info("Stop request")
+        if threading.current_thread() is not self.vendista_loop_thread and self.vendista_loop_thread.is_alive():
+            # Port is closed by vendista_loop on exit
+            self.wakeup()
+            self.vendista_loop_thread.join(timeout=5)
+            return
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
         if self.port and self.port.is_open:
             self.port.close()
             logger.info("Port closed")
         self.port = None
 
+    def wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass # Wakeup is already pending or vendista_loop has exited
+
+    def wait_for_data(self, timeout: float):
+        if self.selector is not None:
+            self.selector.select(timeout)
+            try:
+                self._wakeup_r.recv(64)
+            except BlockingIOError:
+                pass
+            return
+        deadline = time() + timeout
+        while self.port.in_waiting == 0 and self._tx_queue.empty() and time() < deadline:
+            sleep(0.05)
+
+    def process_requests(self):
+        while True:
+            try:
+                packet_type, data, packet, future = self._tx_queue.get_nowait()
+            except Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._transact(packet_type, data, packet))
+                except Exception as e:
+                    # Raised in the caller thread by future.result()
+                    future.set_exception(e)
+
     def vendista_loop(self):
         while not self.stop_request.is_set():
             try:
                 self.open()
                 while not self.stop_request.is_set():
+                    now = time()
                     # Trying to receive
-                    with self.lock:
-                        received = self.port.read_all()
-                    if received is not None:
-                        # Parse events
-                        received = bytearray(received)
-                        while len(received) > 0:
-                            result = self.decode(received)
-                            if result is not None:
-                                self.event(result[0], result[1])
-                            else:
-                                self.get_connect_state()
+                    self.receive()
+                    # Send queued requests
+                    self.process_requests()
                     # Check pending transaction
                     if self.pending_payment is not None:
-                        elapsed = time() - self.pending_payment.get("time", 0)
-                        timeout = 70 if self.pending_payment.get("active", False) else 50
+                        elapsed = now - self.pending_payment.time
+                        timeout = 70 if self.pending_payment.active else 50
                         if elapsed > timeout:
                             self.close_payment()
                     # Check connection status
@@ -182,170 +352,315 @@ class Vendista(object):
                         self.connect_state = ConnectState.DISCONNECTED
                     elif self.error_counter > 5 and self.connect_state > ConnectState.NONE:
                         self.connect_state = ConnectState.NONE
-                        logger.error(f"Connect state: {self.connect_state}")
-                    if self.last_check_time is None or time() - self.last_check_time > 10:
-                        self.last_check_time = time()
+                        logger.error(f"Connect state: {CONNECT_STATE_DESC[self.connect_state]}")
+                    if self.last_check_time is None or now - self.last_check_time > 10:
+                        self.last_check_time = now
                         self.get_connect_state()
                     # Prevent sleep of terminal
-                    if self.last_request_time is not None and time() - self.last_request_time > 10*60:
+                    if self.last_request_time is not None and now - self.last_request_time > 10*60:
                         if self.connect_state == ConnectState.SERVER_CONNECTED:
-                            self.show_picture(Picture.SELECT_GOODS)
+                            self.show_picture(Picture.SELECT_GOODS, force=True)
                         else:
-                            self.show_picture(Picture.UNAVAILABLE)
-                    sleep(0.5)
+                            self.show_picture(Picture.UNAVAILABLE, force=True)
+                    self.wait_for_data(0.5)
             except SerialException as e:
-                if self.lock.locked():
-                    self.lock.release()
                 self.connect_state = ConnectState.NONE
                 logger.error(f"Error opening or communicating with serial port: {e}")
                 sleep(1)
         self.close() 
+        self._wakeup_r.close()
+        self._wakeup_w.close()
         logger.info("Stopped")
 
+    def receive(self):
+        waiting = self.port.in_waiting
+        if waiting:
+            tail = self._rx_tail
+            count = min(waiting, len(self._rx_buf) - tail)
+            self._rx_tail += self.port.readinto(self._rx_view[tail:tail + count])
+            self._rx_time = time()
+        # Parse all complete packets
+        offset = 0
+        results = []
+        failed = False
+        while offset < self._rx_tail:
+            result, next_offset = self.decode(self._rx_view[:self._rx_tail], offset)
+            if next_offset == offset:
+                break # Incomplete packet, wait for the rest
+            offset = next_offset
+            if result is not None:
+                if result[0] == Type.ACK and self._pending_raw_acks:
+                    self._pending_raw_acks -= 1
+                    continue
+                results.append(result)
+            else:
+                failed = True
+        # Keep the incomplete packet at the start of the buffer
+        remaining = self._rx_tail - offset
+        if remaining and (remaining == len(self._rx_buf) or time() - self._rx_time > 1.0):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Drop incomplete packet: {self._rx_view[offset:self._rx_tail].hex(' ').upper()}")
+            remaining = 0
+        elif remaining and offset:
+            self._rx_buf[:remaining] = self._rx_buf[offset:self._rx_tail]
+        self._rx_tail = remaining
+        # Handlers may send requests, so they run after the buffer is consistent
+        self._dispatch(results)
+        if failed:
+            self.get_connect_state()
+
+    def _dispatch(self, results: list[tuple[Type, bytes]]):
+        events = []
+        for packet_type, body in results:
+            event = self.event(packet_type, body)
+            if event is not None:
+                events.append(event)
+        # Publish after the whole burst is decoded
+        for event in events:
+            self.event_queue.put(event)
+
     def request(self, packet_type: Type, data: bytes | None = None):
-        if data is not None:
-            body = bytes(packet_type) + data
-        else:
-            body = bytes(packet_type)
-        logger.debug(f"Send packet: {str(packet_type)}, {body.hex(' ').upper()}")
-        body_length = len(body)
-        crc16 = libscrc.hacker16(body, poly=0x8005, init=0xFFFF, xorout=0xFFFF, refin=False, refout=False)
-        packet = self.header_format.pack(body_length, crc16) + body
+        if data is None and packet_type in PREBUILT_PACKETS:
+            return self._submit(packet_type, packet=PREBUILT_PACKETS[packet_type])
+        return self._submit(packet_type, data)
+
+    def _submit(self, packet_type: Type, data: bytes | None = None, packet: bytes | None = None):
+        if data is not None and not isinstance(data, bytes):
+            # Raises TypeError here, in the caller thread, for data that isn't bytes-like.
+            # Mutable buffers are copied, the caller may change them before they are sent
+            with memoryview(data) as view:
+                data = view.tobytes()
+        if threading.current_thread() is self.vendista_loop_thread:
+            return self._transact(packet_type, data, packet)
+        if self.stop_request.is_set():
+            return
+        future = Future()
+        self._tx_queue.put((packet_type, data, packet, future))
+        self.wakeup()
+        try:
+            return future.result(timeout=5)
+        except TimeoutError:
+            if not future.cancel():
+                # Already being sent, wait for the response (header and body read timeouts)
+                try:
+                    return future.result(timeout=5)
+                except TimeoutError:
+                    pass
+            logger.debug(f"Request timeout: {TYPE_DESC[packet_type]}")
+
+    def _read_exact(self, count: int):
+        tail = self._rx_tail
+        self._rx_tail += self.port.readinto(self._rx_view[tail:tail + count])
+        self._rx_time = time()
+
+    def _read_packet(self):
+        # Blocking read of the rest of the packet at the start of the receive buffer
+        size = self.header_format.size
+        if self._rx_tail < size:
+            self._read_exact(size - self._rx_tail)
+            if self._rx_tail < size:
+                return False
+        body_length, _ = self.header_format.unpack_from(self._rx_buf)
+        packet_len = size + body_length
+        if packet_len > len(self._rx_buf):
+            return False
+        if self._rx_tail < packet_len:
+            self._read_exact(packet_len - self._rx_tail)
+        return self._rx_tail >= packet_len
+
+    def _note_error(self):
+        self.error_counter = min(self.error_counter + 1, 10)
+
+    def _encode_into(self, packet_type: Type, data: bytes | None):
+        # Serialize into the send buffer, it is only used by vendista_loop thread
+        data_length = len(data) if data is not None else 0
+        if 5 + data_length > len(self._tx_buf):
+            return encode_packet(packet_type, data)
+        body_length = 1 + data_length
+        self._tx_buf[4] = packet_type
+        if data_length:
+            self._tx_buf[5:4 + body_length] = data
+        crc16 = calc_crc16(self._tx_view[4:4 + body_length])
+        self.header_format.pack_into(self._tx_buf, 0, body_length, crc16)
+        return self._tx_view[:4 + body_length]
+
+    def _transact(self, packet_type: Type, data: bytes | None, packet: bytes | None = None):
         self.last_request_time = time()
         try:
             self.open()
-            self.lock.acquire()
+            # Packets sent by the terminal on its own must not be taken as the response
+            while self.port.in_waiting or self._rx_tail:
+                if self._rx_tail and not self._read_packet():
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Drop incomplete packet: {self._rx_view[:self._rx_tail].hex(' ').upper()}")
+                    self._rx_tail = 0
+                self.receive()
+            # Encode after receive(), its handlers may send requests through the same buffer
+            if packet is None:
+                packet = self._encode_into(packet_type, data)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Send packet: {TYPE_DESC[packet_type]}, {packet[4:].hex(' ').upper()}")
             self.port.write(packet)
-            received = bytearray(self.port.read(128))
-            self.lock.release()
+            if packet_type != Type.CONNECT_STATE_REQUEST:
+                # Other commands may change what the terminal displays
+                self._last_shown_picture = None
+            shown = packet[5] if packet_type == Type.SHOW_PICTURE else None
+            # Read exactly one packet, anything after it is picked up by vendista_loop
+            notifications = []
+            while True:
+                self._read_packet()
+                received = self._rx_view[:self._rx_tail].tobytes()
+                self._rx_tail = 0 # Response is consumed here, an incomplete one is dropped
+                response = self.decode(memoryview(received))[0] if len(received) else None
+                if response is not None and response[0] == Type.ACK and self._pending_raw_acks:
+                    # ACK of a packet sent by _send_raw, the response follows it
+                    self._pending_raw_acks -= 1
+                    continue
+                if response is None or response[0] not in self._event_handlers:
+                    break
+                # Terminal sent a notification before the response
+                notifications.append(response)
+            if shown is not None and response is not None and response[0] == Type.ACK:
+                self._last_shown_picture = shown
+            # Handlers may send requests, so they run after the response is read
+            self._dispatch(notifications)
+            if response is not None:
+                (packet_type, body) = response
+                if packet_type == Type.ACK:
+                    self.error_counter = 0
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Response: {TYPE_DESC[packet_type]}")
+                    return packet_type
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Response: {TYPE_DESC[packet_type]}, {body.hex(' ').upper()}")
+                return packet_type, body
+            self._note_error()
             if len(received):
-                response = self.decode(received)
-                if response is not None:
-                    (packet_type, body) = response
-                    if packet_type == Type.ACK:
-                        self.error_counter = 0
-                        logger.debug(f"Response: {str(packet_type)}")
-                        while len(received) > 0:
-                            result = self.decode(received)
-                            if result is not None:
-                                self.event(result[0], result[1])                        
-                        return packet_type
-                    logger.debug(f"Response: {str(packet_type)}, {body.hex(' ').upper()}")
-                    while len(received) > 0:
-                        result = self.decode(received)
-                        if result is not None:
-                            self.event(result[0], result[1])                    
-                    return packet_type, body
-                else:
-                    if self.error_counter < 10:
-                        self.error_counter += 1 
+                if logger.isEnabledFor(logging.DEBUG):
                     logger.debug(f"Bad response: {received.hex(' ').upper()}")
             else:
-                if self.error_counter < 10:
-                    self.error_counter += 1 
+                # Terminal is silent, ACKs of earlier raw packets won't come either
+                self._pending_raw_acks = 0
                 logger.debug("No response")
         except SerialException as e:
-            self.lock.release()
-            if self.error_counter < 10:
-                self.error_counter += 1
+            self._note_error()
             logger.error(f"Error opening or communicating with serial port: {e}")
 
-    def decode(self, data: bytearray):
-        if len(data) < 5:
-            logger.debug(f"Invalid packet: {data.hex(' ').upper()}")
-            return
-        body_length, crc16 = self.header_format.unpack_from(data)
+    def decode(self, data: memoryview, offset: int = 0):
+        # Offset is returned unchanged while the packet is incomplete
+        if len(data) - offset < self.header_format.size:
+            return None, offset
+        body_length, crc16 = self.header_format.unpack_from(data, offset)
+        if body_length == 0:
+            logger.debug("Empty packet")
+            return None, offset + self.header_format.size
         packet_len = body_length + 4
-        if len(data) < packet_len:
-            logger.debug(f"Invalid length: {data.hex(' ').upper()}")
-            return
-        body = data[4:packet_len]
-        del data[:packet_len]
-        body_crc16 = libscrc.hacker16(body, poly=0x8005, init=0xFFFF, xorout=0xFFFF, refin=False, refout=False)
-        if body_crc16 != crc16:
-            logger.debug("Invalid crc")
-            return
+        if packet_len > len(self._rx_buf):
+            # Can never be completed, skip the header instead of stalling the buffer
+            logger.debug(f"Invalid length: {body_length}")
+            return None, offset + self.header_format.size
+        if len(data) - offset < packet_len:
+            return None, offset
+        body = data[offset + 4:offset + packet_len] # Zero-copy view
+        offset += packet_len
+        if self.verify_crc:
+            body_crc16 = calc_crc16(body)
+            if body_crc16 != crc16:
+                logger.debug("Invalid crc")
+                return None, offset
         try:
             packet_type = Type(body[0])
         except ValueError:
             logger.debug(f"Unknown type: {body[0]}")
-            return
-        return packet_type, bytes(body[1:])
+            return None, offset
+        return (packet_type, body[1:].tobytes()), offset
     
     def event(self, packet_type: Type, data: bytes):
-        if packet_type == Type.TOUCH:
-            self.event_queue.put(dict(
-                sender = self, 
-                type = packet_type))
-        elif packet_type == Type.CARD_READ_RESULT:
-            result, card = self.packet_card_read_result.unpack_from(data)
-            if result == 0x00:
-                logger.debug("Card not found")
-                if self.pending_payment is not None:
-                    self.pending_payment["time"] = time()
-                    self.pending_payment["active"] = False
-            elif result == 0x01:
-                logger.debug("Card found, but not readed")
-                if self.pending_payment is not None:
-                    self.pending_payment["time"] = time()
-                    self.pending_payment["active"] = False
-            elif result == 0x02:
-                card_number = binascii.hexlify(bytes(card)).decode()
-                card_number = card_number[:4] + "********" + card_number[12:]
-                logger.debug(f"Card {card_number} readed")
-                if type(self.pending_payment) == dict:
-                    self.pending_payment["card_number"] = card_number
-                    self.pending_payment["time"] = time()
-                    self.pending_payment["active"] = False
-        elif packet_type == Type.CARD_AUTH_RESULT:
-            if len(data) == 1:
-                if data[0] == 0x01:
-                    if (self.pending_payment is not None):
-                        amount = self.pending_payment.get("amount", 0)
-                        card_number = self.pending_payment.get("card_number", "")
-                        logger.debug(f"Card auth ok")
-                        self.event_queue.put(dict(
-                            sender = self,
-                            type = packet_type,
-                            amount = amount,
-                            card_number = card_number))
-                else:
-                    logger.error(f"Card auth fail")
-            else:
-                logger.debug(f"Card auth len {len(data)}")
+        handler = self._event_handlers.get(packet_type)
+        if handler is not None:
+            return handler(data)
+
+    def _on_touch(self, data: bytes):
+        return dict(
+            sender = self, 
+            type = Type.TOUCH)
+
+    def _on_card_read(self, data: bytes):
+        result, card = self.packet_card_read_result.unpack_from(data)
+        if result == 0x00:
+            logger.debug("Card not found")
             if self.pending_payment is not None:
-                self.pending_payment["time"] = time()
-                self.pending_payment["active"] = False
-        elif packet_type == Type.CONNECT_STATE_REPORT:
-            if len(data) == 1:
-                try:
-                    connect_state = ConnectState(data[0])
-                except ValueError:
-                    connect_state = ConnectState.NONE
-                self.error_counter = 0
-                if connect_state != self.connect_state:
-                    if self.connection_error and connect_state == ConnectState.SERVER_CONNECTED:
-                        # Соединение восстановлена
-                        self.event_queue.put(dict(
-                            sender = self,
-                            type = packet_type,
-                            state = str(connect_state)))
-                    elif self.connect_state == ConnectState.SERVER_CONNECTED:
-                        # Соединение потеряно
-                        self.connection_error = True 
-                        self.event_queue.put(dict(
-                            sender = self,
-                            type = packet_type,
-                            state = str(connect_state)))
-                    self.connect_state = connect_state
-                    logger.info(f"Connect state: {connect_state}")
-                    if self.connect_state == ConnectState.SERVER_CONNECTED:
-                        self.show_picture(Picture.SELECT_GOODS)
-                    else:
-                        self.show_picture(Picture.UNAVAILABLE)
-
-    def show_picture(self, id):
-        result = self.request(Type.SHOW_PICTURE, id.to_bytes(1))
+                self.pending_payment.time = time()
+                self.pending_payment.active = False
+        elif result == 0x01:
+            logger.debug("Card found, but not readed")
+            if self.pending_payment is not None:
+                self.pending_payment.time = time()
+                self.pending_payment.active = False
+        elif result == 0x02:
+            card_number = f"{card[:2].hex()}********{card[6:].hex()}"
+            logger.debug(f"Card {card_number} readed")
+            if self.pending_payment is not None:
+                self.pending_payment.card_number = card_number
+                self.pending_payment.time = time()
+                self.pending_payment.active = False
+
+    def _on_card_auth(self, data: bytes):
+        event = None
+        if len(data) == 1:
+            if data[0] == 0x01:
+                if (self.pending_payment is not None):
+                    amount = self.pending_payment.amount
+                    card_number = self.pending_payment.card_number
+                    logger.debug(f"Card auth ok")
+                    event = dict(
+                        sender = self,
+                        type = Type.CARD_AUTH_RESULT,
+                        amount = amount,
+                        card_number = card_number)
+            else:
+                logger.error(f"Card auth fail")
+        else:
+            logger.debug(f"Card auth len {len(data)}")
+        if self.pending_payment is not None:
+            self.pending_payment.time = time()
+            self.pending_payment.active = False
+        return event
+
+    def _on_connect_state(self, data: bytes):
+        event = None
+        if len(data) == 1:
+            try:
+                connect_state = ConnectState(data[0])
+            except ValueError:
+                connect_state = ConnectState.NONE
+            self.error_counter = 0
+            if connect_state != self.connect_state:
+                if self.connection_error and connect_state == ConnectState.SERVER_CONNECTED:
+                    # Соединение восстановлена
+                    event = dict(
+                        sender = self,
+                        type = Type.CONNECT_STATE_REPORT,
+                        state = CONNECT_STATE_DESC[connect_state])
+                elif self.connect_state == ConnectState.SERVER_CONNECTED:
+                    # Соединение потеряно
+                    self.connection_error = True 
+                    event = dict(
+                        sender = self,
+                        type = Type.CONNECT_STATE_REPORT,
+                        state = CONNECT_STATE_DESC[connect_state])
+                self.connect_state = connect_state
+                logger.info(f"Connect state: {CONNECT_STATE_DESC[connect_state]}")
+                if self.connect_state == ConnectState.SERVER_CONNECTED:
+                    self.show_picture(Picture.SELECT_GOODS)
+                else:
+                    self.show_picture(Picture.UNAVAILABLE)
+        return event
+
+    def show_picture(self, id, force=False):
+        if not force and id == self._last_shown_picture:
+            return True
+        result = self._submit(Type.SHOW_PICTURE, id.to_bytes(1), PREBUILT_SHOW_PICTURE.get(id))
         return result == Type.ACK
 
     def get_connect_state(self):
@@ -353,10 +668,10 @@ class Vendista(object):
         return result == Type.ACK
 
     def read_card(self, sum, currency=Currency.RUB):
-        logger.info(f"Read card request, {sum} {currency}")
-        self.pending_payment = { "amount": sum, "active": True, "time": time() }
+        logger.info(f"Read card request, {sum} {CURRENCY_DESC[currency]}")
+        self.pending_payment = PendingPayment(amount=sum, active=True, time=time())
         unix_time = 0
-        body = self.packet_read_card.pack(int(sum * 100), currency.bcd(), unix_time, 1)
+        body = self.packet_read_card.pack(int(sum * 100), CURRENCY_BCD[currency], unix_time, 1)
         result = self.request(Type.READ_CARD, body)
         return result == Type.ACK
 
@@ -369,13 +684,13 @@ class Vendista(object):
         logger.info("Cancel last transaction")
         result = self.request(Type.CANCEL_LAST_TRANSACTION)
         if self.pending_payment is not None:
-            self.pending_payment["time"] = time()
-            self.pending_payment["active"] = False
+            self.pending_payment.time = time()
+            self.pending_payment.active = False
         return result == Type.ACK
 
     def vend_request(self, sum):
         logger.info(f"Vend request, {sum}")
-        self.pending_payment = { "amount": sum, "active": True, "time": time() }
+        self.pending_payment = PendingPayment(amount=sum, active=True, time=time())
         body = self.packet_vend_request.pack(sum * 100, 1, 1)
         self.request(Type.VEND_REQUEST, body)
 